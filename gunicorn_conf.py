@@ -0,0 +1,22 @@
+"""
+Gunicorn settings for the web backend.
+Usage: gunicorn -c gunicorn_conf.py web_backend:app
+"""
+import os
+
+# Port can be configured via environment variable
+port = int(os.getenv('PORT', 8000))
+
+# Run on all interfaces, protected by Tailscale middleware
+bind = f'0.0.0.0:{port}'
+
+# gevent workers yield while waiting on the relay service
+workers = 2
+worker_class = 'gevent'
+worker_connections = 200
+keepalive = 5
+
+def when_ready(server):
+    print("Starting Tibber Relay Web Backend...")
+    print("Access restricted to Tailscale network (100.x.x.x)")
+    print(f"Dashboard available at http://<tailscale-ip>:{port}/")
@@ -0,0 +1,15 @@
+"""
+Flask JSON provider backed by orjson.
+Shared by tibber_relay.py and web_backend.py.
+"""
+from flask.json.provider import DefaultJSONProvider
+import orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize and parse Flask JSON with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
@@ -25,6 +25,9 @@ if [ -f "requirements.txt" ]; then
     pip install -r requirements.txt
 fi
 
+# Pre-compress static files for WhiteNoise (index.html.gz etc.)
+python -m whitenoise.compress -q --no-brotli static
+
 # Start relay service (with internal API on localhost:8001)
 relay_script="tibber_relay.py"
 relay_log="tibber_relay.log"
@@ -37,12 +40,13 @@ echo "Relay service started (PID: $relay_pid)"
 # Give relay service time to start API server
 sleep 2
 
-# Start web backend (proxies to relay API)
-web_script="web_backend.py"
+# Start web backend (proxies to relay API) under gunicorn, see gunicorn_conf.py
+web_app="web_backend:app"
 web_log="web_backend.log"
+web_port="${PORT:-8000}"
 
-echo "Starting web backend ($web_script)..."
-nohup $python_bin -u "$web_script" >> "$web_log" 2>&1 &
+echo "Starting web backend ($web_app)..."
+nohup gunicorn -c gunicorn_conf.py "$web_app" >> "$web_log" 2>&1 &
 web_pid=$!
 echo "Web backend started (PID: $web_pid)"
 
@@ -57,7 +61,7 @@ echo "  Log: $relay_log"
 echo ""
 echo "Web Backend:"
 echo "  PID: $web_pid"
-echo "  Dashboard: http://<tailscale-ip>:8000/"
+echo "  Dashboard: http://<tailscale-ip>:$web_port/"
 echo "  Log: $web_log"
 echo ""
 echo "To stop services:"
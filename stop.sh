@@ -6,15 +6,15 @@
 echo "Stopping Tibber Relay services..."
 
 pkill -f tibber_relay.py
-pkill -f web_backend.py
+pkill -f web_backend
 
 # Wait a moment to let processes terminate
 sleep 1
 
 # Check if any processes are still running
-if pgrep -f "tibber_relay.py|web_backend.py" > /dev/null; then
+if pgrep -f "tibber_relay.py|web_backend" > /dev/null; then
     echo "Warning: Some processes may still be running"
-    pgrep -af "tibber_relay.py|web_backend.py"
+    pgrep -af "tibber_relay.py|web_backend"
 else
     echo "All services stopped successfully"
 fi
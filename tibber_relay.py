@@ -1,37 +1,89 @@
 #!/bin/env python3
-import iso8601
+import atexit
+import bisect
+import hashlib
+import heapq
 import json
+import logging
+import orjson
 import os
+import queue
+import re
 import requests
 import schedule
+import signal
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from waitress import serve
 import sys
 import time
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from enum import Enum
 from flask import Flask, jsonify, request as flask_request
+from json_provider import OrjsonProvider
 from threading import Thread
 
 # Output to stdout and stderr directly, no buffering
 sys.stdout.reconfigure(line_buffering=True)  # Python 3.7+
 sys.stderr.reconfigure(line_buffering=True)
 
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+log = logging.getLogger('tibber')
+
 # Load environment variables
 load_dotenv()
 
 tibber_token = os.getenv("TIBBER_API_TOKEN")
 tibber_url = "https://api.tibber.com/v1-beta/gql"
+# GraphQL request body, serialized once
+TIBBER_QUERY_BODY = orjson.dumps({
+    "query": "{ viewer { homes { currentSubscription { priceInfo { today { total startsAt } tomorrow { total startsAt } } } } } }"
+})
 relay_ip_addr = "192.168.1.106"
 relay_instance_id = 0  # Relay ID from within the Shelly unit
 price_limit_sek = 0.2
+status_api_max_age = 10  # Seconds a relay status read may be reused for /api/status
+status_response_ttl = 1.0  # Seconds a whole /api/status response may be reused
 
 price_data = {}
 
+# Shared keep-alive HTTP sessions (connection pooling + TLS session reuse)
+# The Tibber GraphQL query only reads data, so its POST is safe to retry
+_http_retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                    allowed_methods=None)
+
+tibber_session = requests.Session()
+tibber_session.headers.update({
+    "Authorization": f"Bearer {tibber_token}",
+    "Content-Type": "application/json",
+})
+tibber_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2,
+                                             max_retries=_http_retry))
+tibber_timeout = (5, 15)  # (connect, read) seconds
+
+# Shelly calls only retry failed connects: a read timeout already cost the full
+# wait and may mean the command was received, so it is left to the breaker
+shelly_session = requests.Session()
+shelly_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                                            max_retries=Retry(total=2, connect=2, read=0,
+                                                              backoff_factor=0.3,
+                                                              status_forcelist=[502, 503, 504])))
+shelly_timeout = (1.0, 2.0)  # (connect, read) seconds, LAN round-trips are sub-ms
+shelly_failure_limit = 3  # Consecutive failed Shelly calls before pausing calls
+shelly_pause_seconds = 30  # How long to skip Shelly calls once the limit is hit
+
 # Configuration file
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.json')
 
-# State log file
-STATE_LOG_FILE = os.path.join(os.path.dirname(__file__), 'relay_state_log.json')
+# State log file (JSON Lines, append-only)
+STATE_LOG_FILE = os.path.join(os.path.dirname(__file__), 'relay_state_log.jsonl')
+LEGACY_STATE_LOG_FILE = os.path.join(os.path.dirname(__file__), 'relay_state_log.json')
+
+# Price cache file (epoch-second keys, survives restarts)
+PRICE_CACHE_FILE = os.path.join(os.path.dirname(__file__), 'price_cache.json')
 
 def load_config():
     """Load configuration from config.json file."""
@@ -47,14 +99,14 @@ def load_config():
         try:
             with open(CONFIG_FILE, 'r') as f:
                 config = json.load(f)
-                print(f"Loaded configuration from {CONFIG_FILE}")
+                log.info("Loaded configuration from %s", CONFIG_FILE)
                 return config
         except Exception as e:
-            print(f"Error loading config file: {e}", file=sys.stderr)
-            print("Using default configuration")
+            log.error("Error loading config file: %s", e)
+            log.info("Using default configuration")
             return default_config
     else:
-        print(f"No config file found, using defaults")
+        log.info("No config file found, using defaults")
         return default_config
 
 def save_config(mode, price_limit, n_cheapest):
@@ -68,9 +120,25 @@ def save_config(mode, price_limit, n_cheapest):
     try:
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=2)
-        print(f"Configuration saved to {CONFIG_FILE}")
+        log.info("Configuration saved to %s", CONFIG_FILE)
     except Exception as e:
-        print(f"Error saving config file: {e}", file=sys.stderr)
+        log.error("Error saving config file: %s", e)
+
+def body_etag(body):
+    """Return a short content hash of a serialized response body, for use as ETag."""
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def etag_response(body, etag=None):
+    """Return a JSON response with an ETag, or 304 if the client already has it."""
+    response = api.response_class(body, mimetype='application/json')
+    response.set_etag(etag or body_etag(body))
+    # Revalidate every time; a 304 costs no body transfer
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(flask_request)
+
+def current_hour():
+    """Return the current time truncated to the hour (price data resolution)."""
+    return datetime.now().replace(minute=0, second=0, microsecond=0)
 
 def log_relay_state(relay_on=None, mode=None, override_state=None, price=None, mode_decision=None, relay_obj=None):
     """Append current relay state to log file.
@@ -104,88 +172,260 @@ def log_relay_state(relay_on=None, mode=None, override_state=None, price=None, m
         'mode_decision': mode_decision
     }
 
-    try:
-        # Load existing log
-        if os.path.exists(STATE_LOG_FILE):
-            with open(STATE_LOG_FILE, 'r') as f:
-                states = json.load(f)
-        else:
-            states = []
+    # Always append (no deduplication); written by the state log thread
+    _state_log_queue.put_nowait(state_entry)
+    log.info("Logged state: relay_on=%s, mode=%s, time=%s",
+             relay_on, mode.name, now.isoformat())
 
-        # Always append (no deduplication)
-        states.append(state_entry)
+def state_log_writer():
+    """Append queued state entries to STATE_LOG_FILE until a None sentinel arrives."""
+    while True:
+        entries = [_state_log_queue.get()]
+        # Drain whatever else is queued so a burst costs one open()
+        while True:
+            try:
+                entries.append(_state_log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        done = None in entries
+        entries = [e for e in entries if e is not None]
+        try:
+            with open(STATE_LOG_FILE, 'ab') as f:
+                f.writelines(orjson.dumps(e) + b'\n' for e in entries)
+        except Exception as e:
+            log.error("Error logging state: %s", e)
+        if done:
+            return
+
+def flush_state_log():
+    """Write pending state entries before exit (bounded wait for a stuck disk)."""
+    _state_log_queue.put_nowait(None)
+    _state_log_thread.join(timeout=5)
 
-        # Save
-        with open(STATE_LOG_FILE, 'w') as f:
-            json.dump(states, f, indent=2)
+# State log entries are written off the relay update path, by a thread
+# that main() starts; importing the module leaves the log file alone
+_state_log_queue = queue.Queue()
+_state_log_thread = Thread(target=state_log_writer, name='state-log', daemon=True)
 
-        print(f"Logged state: relay_on={relay_on}, mode={mode.name}, time={now.isoformat()}")
+def migrate_state_log():
+    """Convert the legacy JSON-array state log to JSON Lines, once."""
+    if os.path.exists(STATE_LOG_FILE) or not os.path.exists(LEGACY_STATE_LOG_FILE):
+        return
+
+    # Write a temporary file next to the log and rename it into place, so an
+    # interrupted migration never leaves a truncated log that blocks a retry
+    tmp_file = STATE_LOG_FILE + '.tmp'
+    try:
+        with open(LEGACY_STATE_LOG_FILE, 'r') as f:
+            states = json.load(f)
+        with open(tmp_file, 'w') as f:
+            for state_entry in states:
+                f.write(json.dumps(state_entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, STATE_LOG_FILE)
+        log.info("Migrated %d state log entries to %s", len(states), STATE_LOG_FILE)
     except Exception as e:
-        print(f"Error logging state: {e}", file=sys.stderr)
+        log.error("Error migrating state log: %s", e)
+
+def start_state_log():
+    """Migrate a legacy state log, start the writer thread and flush it at exit."""
+    migrate_state_log()
+    _state_log_thread.start()
+    atexit.register(flush_state_log)
 
 class PriceList:
-    def __init__(self, n_cheapest_limit=5):
+    def __init__(self, n_cheapest_limit=5, session=None):
+        self._session = session if session is not None else requests.Session()
+        self.data = {}  # Populated from the price cache and by fetch()
+        self._starts_at = {}  # Raw Tibber startsAt -> parsed datetime key
+        self._last_fetch_etag = None
+        self._last_modified = None
+        self._by_date = {}  # date -> [(datetime, price), ...] sorted by time
+        self._times = []  # Sorted start times of all price slots
+        self._cheap_hours = frozenset()  # N cheapest hours of each day
+        self._cheap_version = 0  # Bumped whenever _cheap_hours is rebuilt
+        self._prices_api_cache = None  # Serialized /api/prices body
+        self._prices_api_version = None  # _cheap_version the body was built from
+        self._prices_api_etag = None  # ETag of _prices_api_cache
         self.n_cheapest_limit = n_cheapest_limit
-        self.data = {}  # Initialize empty dict, populated by fetch()
+        self._load_cache()
+
+    @property
+    def n_cheapest_limit(self):
+        return self._n_cheapest_limit
+
+    @n_cheapest_limit.setter
+    def n_cheapest_limit(self, value):
+        self._n_cheapest_limit = value
+        self._recompute_cheap_hours()
+
+    def _reindex(self):
+        """Rebuild the per-date sorted view of self.data and the cheap hours."""
+        by_date = defaultdict(list)
+        for k, v in self.data.items():
+            by_date[k.date()].append((k, v))
+        for items in by_date.values():
+            items.sort()
+
+        self._by_date = dict(by_date)
+        self._times = sorted(self.data)
+        self._recompute_cheap_hours()
+
+    def _recompute_cheap_hours(self):
+        """Rebuild the set of hours that are among the N cheapest of their day."""
+        self._cheap_hours = frozenset(
+            k
+            for items in self._by_date.values()
+            for k, _ in heapq.nsmallest(self._n_cheapest_limit, items,
+                                        key=lambda kv: kv[1])
+        )
+        self._cheap_version += 1
 
     def has_data(self):
         """Check if price data exists for current hour"""
-        now = datetime.now().replace(minute=0, second=0, microsecond=0)
-        return now in self.data
+        return self._slot_get(datetime.now()) is not None
 
-    def fetch(self):
-        headers = {
-            "Authorization": f"Bearer {tibber_token}",
-            "Content-Type": "application/json",
-        }
+    def has_tomorrow_data(self):
+        """Check if any price data exists for tomorrow"""
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        return any(k.date() == tomorrow for k in self.data)
+
+    def _load_cache(self):
+        """Load cached prices from PRICE_CACHE_FILE."""
+        if not os.path.exists(PRICE_CACHE_FILE):
+            return
+
+        try:
+            with open(PRICE_CACHE_FILE, 'r') as f:
+                cached = json.load(f)
+            self.data = {
+                datetime.fromtimestamp(int(ts)): price
+                for ts, price in cached.items()
+            }
+            self._prune()
+            self._reindex()
+            log.info("Loaded %d cached prices from %s", len(self.data), PRICE_CACHE_FILE)
+        except Exception as e:
+            log.error("Error loading price cache: %s", e)
 
-        body = {
-            "query": "{ viewer { homes { currentSubscription { priceInfo { today { total startsAt } tomorrow { total startsAt } } } } } }"
-        }
+    def _save_cache(self):
+        """Save prices to PRICE_CACHE_FILE."""
+        cached = {str(int(k.timestamp())): v for k, v in self.data.items()}
 
         try:
-            response = requests.post(tibber_url, headers=headers,
-                                     json=body, timeout=15)
+            with open(PRICE_CACHE_FILE, 'w') as f:
+                json.dump(cached, f)
+        except Exception as e:
+            log.error("Error saving price cache: %s", e)
+
+    def _prune(self):
+        """Drop prices older than yesterday to keep the cache bounded."""
+        cutoff = datetime.now().replace(hour=0, minute=0, second=0,
+                                        microsecond=0) - timedelta(days=1)
+        self.data = {k: v for k, v in self.data.items() if k >= cutoff}
+        self._starts_at = {s: k for s, k in self._starts_at.items()
+                           if k >= cutoff}
+
+    def fetch(self):
+        headers = {}
+        if self._last_fetch_etag:
+            headers["If-None-Match"] = self._last_fetch_etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+
+        try:
+            response = self._session.post(tibber_url, headers=headers,
+                                          data=TIBBER_QUERY_BODY,
+                                          timeout=tibber_timeout)
+            if response.status_code == 304:
+                log.info("Price data not modified since last fetch")
+                return
             response.raise_for_status()
-            data = response.json().get("data", {}).get("viewer", {}).get("homes", [{}])[0]
+            self._last_fetch_etag = response.headers.get("ETag")
+            self._last_modified = response.headers.get("Last-Modified")
+
+            data = orjson.loads(response.content).get("data", {}).get("viewer", {}).get("homes", [{}])[0]
             price_info = data.get("currentSubscription", {}).get("priceInfo", {})
 
             today_prices = price_info.get("today", [])
             tomorrow_prices = price_info.get("tomorrow", [])
             date_price = today_prices + tomorrow_prices
 
-            self.data = {
-                iso8601.parse_date(item['startsAt']).replace(tzinfo=None): item['total']
-                for item in date_price
-            }
-            print(self.data)
+            # Only parse timestamps not seen before
+            for item in date_price:
+                starts_at = item['startsAt']
+                key = self._starts_at.get(starts_at)
+                if key is None:
+                    key = datetime.fromisoformat(
+                        starts_at.replace('Z', '+00:00')).replace(tzinfo=None)
+                    self._starts_at[starts_at] = key
+                self.data[key] = item['total']
+
+            self._prune()
+            self._reindex()
+            self._save_cache()
+            log.debug("prices: %r", self.data)
         except requests.RequestException as e:
-            print(f"!Error fetching price data: {e}", file=sys.stderr)
+            log.error("Error fetching price data: %s", e)
         except KeyError as e:
-            print(f"!Error parsing price data: Missing key {e}",
-                  file=sys.stderr)
-
-    def price_now_get(self):
-        now = datetime.now().replace(minute=0, second=0,
-                                     microsecond=0)
-        if now not in self.data:
-            print(f"!Warning: No price data for {now}",
-                  file=sys.stderr)
-            raise Exception("No price data available")
+            log.error("Error parsing price data: Missing key %s", e)
+        except orjson.JSONDecodeError as e:
+            log.error("Error parsing price data: %s", e)
+
+    def prices_api_body_get(self):
+        """Return the serialized /api/prices body, rebuilt only after prices or n_cheapest_limit change."""
+        if self._prices_api_version != self._cheap_version:
+            self._prices_api_cache = orjson.dumps({
+                'prices': [
+                    {
+                        'time': k.isoformat(),
+                        'price': v
+                    }
+                    for day in sorted(self._by_date)
+                    for k, v in self._by_date[day]
+                ],
+                'cheap_hours': [k.isoformat() for k in sorted(self._cheap_hours)],
+                'n_cheapest_limit': self.n_cheapest_limit
+            })
+            self._prices_api_etag = body_etag(self._prices_api_cache)
+            self._prices_api_version = self._cheap_version
+        return self._prices_api_cache
+
+    def fetch_tomorrow(self):
+        """Fetch prices unless tomorrow's are already known (for scheduled retries)."""
+        if self.has_tomorrow_data():
+            log.info("Tomorrow's prices already fetched, skipping")
+            return
+        self.fetch()
 
-        print(f"Price at {now}: {self.data[now]}")
-        return self.data[now]
+    def _slot_get(self, now):
+        """Return the start of the price slot covering now, or None."""
+        i = bisect.bisect_right(self._times, now) - 1
+        if i < 0 or now - self._times[i] >= timedelta(hours=1):
+            return None
+        return self._times[i]
+
+    def price_now_get(self, now=None):
+        if now is None:
+            now = datetime.now()
+        slot = self._slot_get(now)
+        if slot is None:
+            log.warning("No price data for %s", now)
+            raise Exception("No price data available")
 
-    def price_now_is_in_n_cheapest_today(self):
-        now_date = datetime.now().date()
+        log.debug("Price at %s: %s", slot, self.data[slot])
+        return self.data[slot]
 
-        today_prices = [v for k, v in self.data.items()
-                        if k.date() == now_date]
-        today_prices.sort()
-        price_limit = today_prices[self.n_cheapest_limit]
-        now_price = self.price_now_get()
-        print(f"price {now_price} within {self.n_cheapest_limit} cheapest: {now_price <= price_limit}")
-        return now_price <= price_limit
+    def price_now_is_in_n_cheapest_today(self, now=None):
+        if now is None:
+            now = datetime.now()
+        now_price = self.price_now_get(now)
+        in_cheapest = self._slot_get(now) in self._cheap_hours
+        log.info("price %.3f within %d cheapest: %s",
+                 now_price, self.n_cheapest_limit, in_cheapest)
+        return in_cheapest
 
 class RelayMode(Enum):
     PRICE_LIMIT = 1
@@ -198,9 +438,13 @@ class Relay:
 
     def __init__(self, ip, instance_id, price_list,
                  manual_override_nb_runs=5,
-                 relay_mode=RelayMode.PRICE_LIMIT):
+                 relay_mode=RelayMode.PRICE_LIMIT, session=None):
+        self._session = session if session is not None else requests.Session()
         self._ip = ip
         self._id = instance_id
+        # Fast path for the one field we read: "switch:<id>": {... "output": true|false
+        self._output_re = re.compile(
+            rb'"switch:%d"\s*:\s*\{[^{}]*?"output"\s*:\s*(true|false)' % instance_id)
         self._price_list = price_list
         self._mode = relay_mode
         self._prev_status = None  # Status set by this script
@@ -208,21 +452,53 @@ class Relay:
         self._override_state = None  # None (auto), True (forced on), False (forced off)
         self.manual_override_nb_runs = manual_override_nb_runs  # Override delay
         self._errors = {}
+        self._status_cache = (0.0, None)  # (monotonic time, status) of last successful read
+        self._failures = 0  # Consecutive failed Shelly calls
+        self._paused_until = 0.0  # Monotonic time until which Shelly calls are skipped
+
+    def _shelly_available(self):
+        """Check whether Shelly calls are allowed (not paused after repeated failures)."""
+        return time.monotonic() >= self._paused_until
+
+    def _shelly_ok(self):
+        self._failures = 0
+
+    def _shelly_failed(self):
+        self._failures += 1
+        if self._failures >= shelly_failure_limit:
+            self._paused_until = time.monotonic() + shelly_pause_seconds
+            log.warning("Shelly failed %d times in a row, pausing calls for %d s",
+                        self._failures, shelly_pause_seconds)
+
+    def status_get(self, max_age=2.0, force=False):
+        """Return relay output state, reusing a read younger than max_age seconds unless force is set."""
+        ts, cached = self._status_cache
+        if not force and cached is not None and time.monotonic() - ts < max_age:
+            return cached
+        if not self._shelly_available():
+            return None
 
-    def status_get(self):
         try:
-            response = requests.get(
+            response = self._session.get(
                 f"http://{self._ip}/rpc/Shelly.GetStatus?id={self._id}",
-                timeout=5
+                timeout=shelly_timeout
             )
             response.raise_for_status()
-            return response.json().get(f"switch:{self._id}").get("output") is True
-        except requests.RequestException as e:
-            print(f"!Error fetching relay status: {e}",
-                  file=sys.stderr)
+            match = self._output_re.search(response.content)
+            if match is not None:
+                status = match.group(1) == b'true'
+            else:
+                status = orjson.loads(response.content).get(f"switch:{self._id}").get("output") is True
+            self._status_cache = (time.monotonic(), status)
+            self._shelly_ok()
+            return status
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            log.error("Error fetching relay status: %s", e)
+            self._shelly_failed()
             return None
 
     def turn(self, enable):
+        """Switch the relay unless overridden; return the resulting status (None if unknown)."""
         status = self.status_get()
         if (
                 status != self._prev_status
@@ -235,61 +511,90 @@ class Relay:
             self._prev_status = status
 
         if self._overridden_hours_left > 0:
-            print(
-                f"-> External change detected, skipping relay update. "
-                f"{self._overridden_hours_left} loops left"
+            log.info(
+                "-> External change detected, skipping relay update. "
+                "%d loops left", self._overridden_hours_left
             )
             self._overridden_hours_left -= 1
-            return
+            return status
 
         if self._override_state is not None:
             self._override_state = None
-            print("Override period ended, resuming automatic control")
+            log.info("Override period ended, resuming automatic control")
 
         enable_str = "on" if enable else "off"
+        if status == enable:
+            log.info("-> Relay already %s", enable_str)
+            self._prev_status = status
+            return status
+
+        if not self._shelly_available():
+            log.error("Shelly calls paused after repeated failures, not turning relay %s", enable_str)
+            return None
         try:
-            requests.get(
+            response = self._session.get(
                 f"http://{self._ip}/relay/{self._id}?turn={enable_str}",
-                timeout=5
+                timeout=shelly_timeout
             )
+            response.raise_for_status()
+            self._shelly_ok()
         except requests.RequestException as e:
-            print(f"!Error actuating relay: {e}", file=sys.stderr)
-            return
+            log.error("Error actuating relay: %s", e)
+            self._shelly_failed()
+            return None
 
-        print(f"-> Relay {enable_str}")
-        time.sleep(3)  # Give Shelly time to process command before checking status
-        self._prev_status = self.status_get()
+        self._status_cache = (0.0, None)  # State changed, drop the cached read
+        log.info("-> Relay %s", enable_str)
+        try:
+            # The relay endpoint reports the new state in its response
+            status = orjson.loads(response.content)["ison"] is True
+            self._status_cache = (time.monotonic(), status)
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            time.sleep(3)  # Give Shelly time to process command before checking status
+            status = self.status_get(force=True)
+        self._prev_status = status
+        return status
+
+    def _decide_price_limit(self, now):
+        return self._price_list.price_now_get(now) < price_limit_sek
+
+    def _decide_n_cheapest_today(self, now):
+        return self._price_list.price_now_is_in_n_cheapest_today(now)
+
+    # Mode -> decision function returning whether the relay should be on
+    _MODE_DISPATCH = {
+        RelayMode.PRICE_LIMIT: _decide_price_limit,
+        RelayMode.N_CHEAPEST_TODAY: _decide_n_cheapest_today,
+    }
 
     def update(self, retry=True):
+        hour = current_hour()  # Same hour for every lookup in this pass
         try:
-            if self._mode == RelayMode.PRICE_LIMIT:
-                enable = (
-                    self._price_list.price_now_get() < price_limit_sek
-                )
-            elif self._mode == RelayMode.N_CHEAPEST_TODAY:
-                enable = self._price_list.price_now_is_in_n_cheapest_today()
-            else:
+            decide = self._MODE_DISPATCH.get(self._mode)
+            if decide is None:
                 raise ValueError(f"Unidentified mode")
+            enable = decide(self, hour)
 
-            self.turn(enable)
+            current_status = self.turn(enable)
             self._errors.pop('price_fetch', None)
 
             # Log the state after update
-            current_status = self.status_get()
+            if current_status is None:
+                current_status = self.status_get()
             if current_status is not None:
                 try:
-                    current_price = self._price_list.price_now_get()
+                    current_price = self._price_list.price_now_get(hour)
                 except:
                     current_price = None
                 log_relay_state(current_status, self._mode, self._override_state, current_price, enable)
         except Exception as e:
             if retry:
-                print("Price data missing, fetching fresh prices...")
+                log.info("Price data missing, fetching fresh prices...")
                 self._price_list.fetch()
                 self.update(retry=False)
             else:
                 error_msg = f"No price data available: {str(e)}"
-                print(error_msg)
+                log.error(error_msg)
                 self._errors['price_fetch'] = {
                     'message': error_msg,
                     'timestamp': datetime.now().isoformat()
@@ -302,18 +607,53 @@ saved_config = load_config()
 price_limit_sek = saved_config['price_limit_sek']
 
 # Initialize objects at module level so they can be imported
-price_list = PriceList(n_cheapest_limit=saved_config['n_cheapest_limit'])
+price_list = PriceList(n_cheapest_limit=saved_config['n_cheapest_limit'],
+                       session=tibber_session)
 
 # Convert mode string to enum
 relay_mode = RelayMode.PRICE_LIMIT if saved_config['mode'] == 'PRICE_LIMIT' else RelayMode.N_CHEAPEST_TODAY
-relay = Relay(relay_ip_addr, relay_instance_id, price_list, relay_mode=relay_mode)
+relay = Relay(relay_ip_addr, relay_instance_id, price_list, relay_mode=relay_mode,
+              session=shelly_session)
+
+# Scheduled relay updates run on their own thread so a slow Shelly never
+# stalls the scheduler loop; one worker keeps updates in order
+relay_update_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='relay-update')
+
+def log_relay_update_error(future):
+    """Log an exception raised by a background relay update."""
+    e = future.exception()
+    if e is not None:
+        log.error("Relay update failed: %s", e, exc_info=e)
+
+def submit_relay_update():
+    """Queue relay.update on the relay update thread without waiting for it."""
+    relay_update_pool.submit(relay.update).add_done_callback(log_relay_update_error)
+
+# Last /api/status response as (monotonic time, body), dropped by any write
+_status_response_cache = (0.0, None)
 
 # Flask API for inter-service communication (localhost only)
 api = Flask(__name__)
+api.json = OrjsonProvider(api)
+
+@api.after_request
+def invalidate_status_response(response):
+    """Drop the cached /api/status response after any state-changing request."""
+    global _status_response_cache
+
+    if flask_request.method != 'GET':
+        _status_response_cache = (0.0, None)
+    return response
 
 @api.route('/api/status')
 def api_get_status():
     """Get current relay status and price."""
+    global _status_response_cache
+
+    ts, cached = _status_response_cache
+    if cached is not None and time.monotonic() - ts < status_response_ttl:
+        return jsonify(cached)
+
     if not price_list.has_data():
         price_list.fetch()
 
@@ -322,9 +662,10 @@ def api_get_status():
     except Exception:
         current_price = None
 
-    relay_on = relay.status_get()
+    # Relay commands refresh the cached status, so only external changes lag
+    relay_on = relay.status_get(max_age=status_api_max_age)
 
-    return jsonify({
+    status = {
         'relay_on': relay_on,
         'current_price': current_price,
         'mode': relay._mode.name,
@@ -332,7 +673,9 @@ def api_get_status():
         'override_state': relay._override_state,
         'errors': relay._errors,
         'timestamp': datetime.now().isoformat()
-    })
+    }
+    _status_response_cache = (time.monotonic(), status)
+    return jsonify(status)
 
 @api.route('/api/prices')
 def api_get_prices():
@@ -340,29 +683,19 @@ def api_get_prices():
     if not price_list.data:
         price_list.fetch()
 
-    prices = [
-        {
-            'time': time.isoformat(),
-            'price': price
-        }
-        for time, price in sorted(price_list.data.items())
-    ]
-
-    return jsonify({
-        'prices': prices,
-        'n_cheapest_limit': price_list.n_cheapest_limit
-    })
+    body = price_list.prices_api_body_get()
+    return etag_response(body, price_list._prices_api_etag)
 
 @api.route('/api/config')
 def api_get_config():
     """Get current configuration."""
-    return jsonify({
+    return etag_response(orjson.dumps({
         'mode': relay._mode.name,
         'n_cheapest_limit': price_list.n_cheapest_limit,
         'price_limit_sek': price_limit_sek,
         'manual_override_runs': relay.manual_override_nb_runs,
         'relay_ip': relay._ip
-    })
+    }))
 
 @api.route('/api/config', methods=['POST'])
 def api_update_config():
@@ -381,17 +714,17 @@ def api_update_config():
                 relay._mode = RelayMode.N_CHEAPEST_TODAY
             else:
                 return jsonify({'success': False, 'error': f'Invalid mode: {mode_str}'}), 400
-            print(f"Mode updated to: {relay._mode.name}")
+            log.info("Mode updated to: %s", relay._mode.name)
 
         # Update price limit (for PRICE_LIMIT mode)
         if 'price_limit_sek' in data:
             price_limit_sek = float(data['price_limit_sek'])
-            print(f"Price limit updated to: {price_limit_sek} SEK")
+            log.info("Price limit updated to: %s SEK", price_limit_sek)
 
         # Update n_cheapest_limit (for N_CHEAPEST_TODAY mode)
         if 'n_cheapest_limit' in data:
             price_list.n_cheapest_limit = int(data['n_cheapest_limit'])
-            print(f"N cheapest limit updated to: {price_list.n_cheapest_limit}")
+            log.info("N cheapest limit updated to: %d", price_list.n_cheapest_limit)
 
         # Save configuration to file
         save_config(relay._mode.name, price_limit_sek, price_list.n_cheapest_limit)
@@ -422,7 +755,7 @@ def api_command():
                 relay._overridden_hours_left = int(override_hours)
                 relay._override_state = True
                 log_relay_state(relay_obj=relay)
-                print(f"Relay turned on with {override_hours} hour override")
+                log.info("Relay turned on with %s hour override", override_hours)
             return jsonify({'success': True, 'message': 'Relay turned on'})
         elif command == 'turn_off':
             relay.turn(False)
@@ -430,7 +763,7 @@ def api_command():
                 relay._overridden_hours_left = int(override_hours)
                 relay._override_state = False
                 log_relay_state(relay_obj=relay)
-                print(f"Relay turned off with {override_hours} hour override")
+                log.info("Relay turned off with %s hour override", override_hours)
             return jsonify({'success': True, 'message': 'Relay turned off'})
         else:
             return jsonify({'success': False, 'error': 'Unknown command'}), 400
@@ -445,37 +778,53 @@ def api_resume():
         relay._override_state = None
         relay._prev_status = None  # Reset to prevent external change detection
         relay.update()  # Immediately apply automatic control
-        print("Override cleared - automatic control resumed")
+        log.info("Override cleared - automatic control resumed")
         return jsonify({'success': True, 'message': 'Automatic control resumed'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 def run_api_server():
-    """Run Flask API server in background thread (localhost only)."""
-    api.run(host='127.0.0.1', port=8001, debug=False, use_reloader=False)
+    """Run Flask API under waitress in background thread (localhost only)."""
+    serve(api, host='127.0.0.1', port=8001, threads=4,
+          connection_limit=64, channel_timeout=30)
 
-if __name__ == "__main__":
-    print("Starting Tibber Relay Service...")
+def main():
+    """Start the API server and run the relay scheduler forever."""
+    log.info("Starting Tibber Relay Service...")
+
+    # Exit through SystemExit on SIGTERM (systemd stop) so atexit flushes the state log
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_state_log()
 
     # Start API server in background thread (localhost:8001)
     api_thread = Thread(target=run_api_server, daemon=True)
     api_thread.start()
-    print("API server started on http://127.0.0.1:8001")
+    log.info("API server started on http://127.0.0.1:8001")
 
     # Schedule tasks
-    schedule.every().hour.at(":00").do(relay.update)
-    schedule.every().day.at("14:30").do(price_list.fetch)  # Fetch tomorrow's prices (published ~14:15)
-    schedule.every().day.at("15:30").do(price_list.fetch)  # Retry if unavailable
-    schedule.every().day.at("16:30").do(price_list.fetch)  # Second retry
-    schedule.every().day.at("17:30").do(price_list.fetch)  # Third retry
-
-    # Initial fetch and update
-    price_list.fetch()
+    schedule.every().hour.at(":00").do(submit_relay_update)
+    schedule.every().day.at("14:30").do(price_list.fetch_tomorrow)  # Fetch tomorrow's prices (published ~14:15)
+    schedule.every().day.at("15:30").do(price_list.fetch_tomorrow)  # Retry if unavailable
+    schedule.every().day.at("16:30").do(price_list.fetch_tomorrow)  # Second retry
+    schedule.every().day.at("17:30").do(price_list.fetch_tomorrow)  # Third retry
+
+    # Initial fetch (skipped when the cache already covers today and tomorrow)
+    if not (price_list.has_data() and price_list.has_tomorrow_data()):
+        price_list.fetch()
     relay.update()
 
-    print("Scheduler running - relay updates hourly, prices fetched at 14:30 (with retries)")
+    log.info("Scheduler running - relay updates hourly, prices fetched at 14:30 (with retries)")
 
-    # Main scheduler loop
+    # Main scheduler loop, sleeping until the next job is due. Sleeps are
+    # capped so a wall-clock jump (e.g. NTP sync on a Pi without RTC) is
+    # noticed within a few minutes.
     while True:
         schedule.run_pending()
-        time.sleep(60)  # Check every minute
+        idle = schedule.idle_seconds()
+        if idle is None:
+            break
+        if idle > 0:
+            time.sleep(min(idle, 300))
+
+if __name__ == "__main__":
+    main()
@@ -5,35 +5,149 @@ Provides a Flask API for monitoring and controlling the relay via web interface.
 Access restricted to Tailscale network (100.x.x.x).
 
 Communicates with tibber_relay service via HTTP API on localhost:8001
+
+Runs under gunicorn with gevent workers (settings in gunicorn_conf.py):
+    gunicorn -c gunicorn_conf.py web_backend:app
 """
-from flask import Flask, jsonify, request, abort, send_from_directory
-from datetime import datetime
+# Must run before anything else imports socket/threading
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, Response, jsonify, request
+from cachetools import TTLCache
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+import ipaddress
 import requests
+from requests.adapters import HTTPAdapter
+from whitenoise import WhiteNoise
+from json_provider import OrjsonProvider
+import orjson
+import queue
 import sys
 import os
-import json
+import time
 
 app = Flask(__name__, static_folder='static')
+app.json = OrjsonProvider(app)
 
 # Relay service API endpoint (localhost only)
 RELAY_API = 'http://127.0.0.1:8001/api'
 
+# Keep-alive connections to the relay service, shared by all requests
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+# Relay GET responses, shared by concurrent callers for 1 s. Callers that
+# arrive while a request for the same path is in flight share its Future,
+# so they get its result (or its error) instead of queueing their own call.
+_relay_cache = TTLCache(maxsize=16, ttl=1.0)
+_relay_cache_lock = Lock()
+_relay_inflight = {}  # path -> Future of the running relay request
+
+# /api/events: while anyone is subscribed, one poller per worker checks relay
+# status and pushes changes (or a heartbeat) to every subscriber's queue
+EVENTS_POLL_INTERVAL = 5  # seconds between relay status polls
+EVENTS_KEEPALIVE = 15  # seconds of silence before a keep-alive comment
+_event_subscribers = set()
+_event_lock = Lock()
+_event_state = {'poller': None, 'last': None}
+
+# State log written by tibber_relay (JSON Lines)
+STATE_LOG_FILE = os.path.join(os.path.dirname(__file__), 'relay_state_log.jsonl')
+# Parsed history per date: {date: ((log st_mtime_ns, st_size), states)}
+_STATE_CACHE = {}
+
+# Relay service paths /api/batch may call, and the pool running them in parallel
+BATCH_RELAY_PATHS = {'/status', '/prices', '/config'}
+batch_pool = ThreadPoolExecutor(max_workers=8)
+
+# Static files (HTML/CSS/JS) are served by WhiteNoise in front of Flask,
+# including pre-compressed .gz variants from `python -m whitenoise.compress static`.
+# index.html is not content-hashed, so browsers only cache it briefly.
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+app.wsgi_app = WhiteNoise(app.wsgi_app, root=STATIC_DIR, index_file=True,
+                          max_age=60, autorefresh=False)
+
+# Tailscale CGNAT range, and loopback addresses allowed for development/testing
+_TAILNET = ipaddress.ip_network('100.64.0.0/10')
+_LOCAL = {'127.0.0.1', '::1', 'localhost'}
+
+@lru_cache(maxsize=1024)
+def is_tailnet(client_ip):
+    """Check whether client_ip is a Tailscale address (parsed once per distinct IP)."""
+    try:
+        return ipaddress.ip_address(client_ip) in _TAILNET
+    except ValueError:
+        return False
+
 # Tailscale security middleware
-@app.before_request
-def require_tailscale():
-    """Only allow requests from Tailscale network (100.x.x.x)."""
-    client_ip = request.remote_addr
+def tailscale_filter(wsgi_app):
+    """Only allow requests from Tailscale network (100.x.x.x), before Flask or WhiteNoise run."""
+    def wrapper(environ, start_response):
+        client_ip = environ.get('REMOTE_ADDR', '')
 
-    # Allow localhost for development/testing
-    if client_ip in ['127.0.0.1', 'localhost', '::1']:
-        return None
+        # Allow localhost for development/testing
+        if client_ip in _LOCAL or is_tailnet(client_ip):
+            return wsgi_app(environ, start_response)
 
-    # Require Tailscale IP range (100.64.0.0/10)
-    if not client_ip.startswith('100.'):
         print(f"Blocked request from non-Tailscale IP: {client_ip}", file=sys.stderr)
-        abort(403, description="Access restricted to Tailscale network")
+        start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+        return [b'Access restricted to Tailscale network']
+    return wrapper
+
+# Outermost layer, so static files are protected too
+app.wsgi_app = tailscale_filter(app.wsgi_app)
+
+@app.after_request
+def invalidate_relay_cache(response):
+    """Drop cached relay responses after any state-changing request."""
+    if request.method != 'GET' and request.path != '/api/batch':
+        with _relay_cache_lock:
+            _relay_cache.clear()
+    return response
+
+def relay_fetch(path):
+    """GET a relay service path and return (body, ETag); concurrent callers share one call per second."""
+    with _relay_cache_lock:
+        cached = _relay_cache.get(path)
+        if cached is not None:
+            return cached
+        future = _relay_inflight.get(path)
+        owner = future is None
+        if owner:
+            future = _relay_inflight[path] = Future()
+
+    if owner:
+        try:
+            response = SESSION.get(f'{RELAY_API}{path}', timeout=5)
+            response.raise_for_status()
+            cached = (orjson.loads(response.content), response.headers.get('ETag'))
+            with _relay_cache_lock:
+                _relay_cache[path] = cached
+            future.set_result(cached)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with _relay_cache_lock:
+                del _relay_inflight[path]
+    return future.result()
 
-    return None
+def relay_get(path):
+    """GET a relay service path and return the parsed body."""
+    return relay_fetch(path)[0]
+
+def etag_passthrough(path):
+    """Relay a GET response with the relay's ETag, or 304 if the client already has it."""
+    body, etag = relay_fetch(path)
+    response = jsonify(body)
+    if etag:
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 # API Endpoints
 
@@ -41,20 +155,16 @@ def require_tailscale():
 def get_status():
     """Get current relay status, price, and system state."""
     try:
-        response = requests.get(f'{RELAY_API}/status', timeout=5)
-        response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return jsonify(relay_get('/status'))
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
 @app.route('/api/prices')
 def get_prices():
     """Get all available price data (today + tomorrow)."""
     try:
-        response = requests.get(f'{RELAY_API}/prices', timeout=5)
-        response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return etag_passthrough('/prices')
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
 @app.route('/api/relay/on', methods=['POST'])
@@ -66,10 +176,10 @@ def turn_relay_on():
         if 'override_hours' in data:
             payload['override_hours'] = data['override_hours']
 
-        response = requests.post(f'{RELAY_API}/command', json=payload, timeout=5)
+        response = SESSION.post(f'{RELAY_API}/command', json=payload, timeout=5)
         response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return jsonify(orjson.loads(response.content))
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'success': False, 'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
 @app.route('/api/relay/off', methods=['POST'])
@@ -81,20 +191,18 @@ def turn_relay_off():
         if 'override_hours' in data:
             payload['override_hours'] = data['override_hours']
 
-        response = requests.post(f'{RELAY_API}/command', json=payload, timeout=5)
+        response = SESSION.post(f'{RELAY_API}/command', json=payload, timeout=5)
         response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return jsonify(orjson.loads(response.content))
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'success': False, 'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
 @app.route('/api/config')
 def get_config():
     """Get current configuration."""
     try:
-        response = requests.get(f'{RELAY_API}/config', timeout=5)
-        response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return etag_passthrough('/config')
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
 @app.route('/api/config', methods=['POST'])
@@ -102,71 +210,187 @@ def update_config():
     """Update configuration (mode, price limit, n_cheapest)."""
     try:
         data = request.get_json()
-        response = requests.post(f'{RELAY_API}/config', json=data, timeout=5)
+        response = SESSION.post(f'{RELAY_API}/config', json=data, timeout=5)
         response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return jsonify(orjson.loads(response.content))
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'success': False, 'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
 @app.route('/api/resume', methods=['POST'])
 def resume_automatic():
     """Resume automatic control by clearing override."""
     try:
-        response = requests.post(f'{RELAY_API}/resume', timeout=5)
+        response = SESSION.post(f'{RELAY_API}/resume', timeout=5)
         response.raise_for_status()
-        return jsonify(response.json())
-    except requests.RequestException as e:
+        return jsonify(orjson.loads(response.content))
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
         return jsonify({'success': False, 'error': f'Failed to communicate with relay service: {str(e)}'}), 503
 
+def read_lines_reversed(path, chunk_size=64 * 1024):
+    """Yield the lines of a file last to first, reading it backwards in chunks."""
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        tail = b''
+        while pos > 0:
+            step = min(chunk_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b'\n')
+            tail = lines.pop(0)  # May continue in the previous chunk
+            yield from reversed(lines)
+        yield tail
+
+def state_history_get(date_param='today'):
+    """Return logged relay states for 'yesterday' or (default) today."""
+    try:
+        st = os.stat(STATE_LOG_FILE)
+    except FileNotFoundError:
+        return []
+
+    if date_param == 'yesterday':
+        target_date = (datetime.now() - timedelta(days=1)).date()
+    else:  # default to today
+        target_date = datetime.now().date()
+
+    # Reuse the last parse until the log file changes. mtime alone can miss an
+    # append within the same timestamp tick; the append-only log also grows.
+    version = (st.st_mtime_ns, st.st_size)
+    cached = _STATE_CACHE.get(target_date)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    # The log is chronological: scan back from the end and stop before target_date
+    filtered_states = []
+    for line in read_lines_reversed(STATE_LOG_FILE):
+        if not line.strip():
+            continue
+        s = orjson.loads(line)
+        date = datetime.fromisoformat(s['time']).date()
+        if date < target_date:
+            break
+        if date == target_date:
+            filtered_states.append(s)
+    filtered_states.reverse()
+
+    # Entries parsed from an older version of the log are stale
+    for date in [d for d, (v, _) in _STATE_CACHE.items() if v != version]:
+        del _STATE_CACHE[date]
+    _STATE_CACHE[target_date] = (version, filtered_states)
+    return filtered_states
+
 @app.route('/api/state_history')
 def get_state_history():
     """Get relay state history (filtered to specific date, defaults to today)."""
-    state_log_file = os.path.join(os.path.dirname(__file__), 'relay_state_log.json')
-
-    if not os.path.exists(state_log_file):
-        return jsonify({'states': []})
-
     try:
-        with open(state_log_file, 'r') as f:
-            all_states = json.load(f)
-
         # Get date parameter (yesterday, today) or default to today
         date_param = request.args.get('date', 'today')
+        return jsonify({'states': state_history_get(date_param)})
+    except Exception as e:
+        return jsonify({'error': f'Failed to read state history: {str(e)}'}), 500
 
-        if date_param == 'yesterday':
-            from datetime import timedelta
-            target_date = (datetime.now() - timedelta(days=1)).date()
-        else:  # default to today
-            target_date = datetime.now().date()
+def batch_call(call):
+    """Run one read-only /api/batch sub-request and return its result entry."""
+    result = {'id': call.get('id')}
+    path = call.get('path', '')
+    method = call.get('method', 'GET')
+    if not isinstance(path, str) or not isinstance(method, str):
+        result.update(status=400, body={'error': "'path' and 'method' must be strings"})
+        return result
+    url = urlsplit(path)
 
-        filtered_states = [
-            s for s in all_states
-            if datetime.fromisoformat(s['time']).date() == target_date
-        ]
+    if method.upper() != 'GET':
+        result.update(status=405, body={'error': 'Only GET calls can be batched'})
+        return result
 
-        return jsonify({'states': filtered_states})
+    try:
+        if url.path == '/state_history':
+            date_param = parse_qs(url.query).get('date', ['today'])[0]
+            result.update(status=200, body={'states': state_history_get(date_param)})
+        elif url.path in BATCH_RELAY_PATHS:
+            result.update(status=200, body=relay_get(url.path))
+        else:
+            result.update(status=404, body={'error': f'Unknown path: {path}'})
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        result.update(status=503, body={'error': f'Failed to communicate with relay service: {str(e)}'})
     except Exception as e:
-        return jsonify({'error': f'Failed to read state history: {str(e)}'}), 500
+        result.update(status=500, body={'error': str(e)})
+    return result
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Run several read-only API calls concurrently and return results in request order."""
+    data = request.get_json(silent=True)
+    calls = data.get('calls', []) if isinstance(data, dict) else None
+    if not isinstance(calls, list) or not all(isinstance(c, dict) for c in calls):
+        return jsonify({'error': "Expected a JSON object with a 'calls' list of objects"}), 400
+    return jsonify({'results': list(batch_pool.map(batch_call, calls))})
+
+def events_poller():
+    """Poll relay status while there are subscribers and push changes or heartbeats to them."""
+    last = None
+    while True:
+        with _event_lock:
+            if not _event_subscribers:
+                _event_state['poller'] = None
+                _event_state['last'] = None
+                return
+
+        try:
+            status = relay_get('/status')
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            status = {'error': f'Failed to communicate with relay service: {str(e)}'}
+
+        # The timestamp changes on every poll; push the full status only on
+        # real changes, otherwise a heartbeat showing the status is still current
+        data = orjson.dumps(status)
+        changed = {k: v for k, v in status.items() if k != 'timestamp'}
+        if changed != last:
+            last = changed
+            frame = b'data: ' + data + b'\n\n'
+        elif 'error' not in status:
+            frame = (b'event: heartbeat\ndata: ' +
+                     orjson.dumps({'timestamp': status.get('timestamp')}) + b'\n\n')
+        else:
+            frame = None
+
+        with _event_lock:
+            _event_state['last'] = data  # Latest poll, so new subscribers get a fresh timestamp
+            if frame is not None:
+                for q in _event_subscribers:
+                    q.put(frame)
 
-# Serve static files (HTML/CSS/JS)
-@app.route('/')
-def index():
-    """Serve main dashboard page."""
-    return send_from_directory('static', 'index.html')
+        time.sleep(EVENTS_POLL_INTERVAL)
 
-@app.route('/<path:path>')
-def serve_static(path):
-    """Serve other static files."""
-    return send_from_directory('static', path)
+def events_subscribe():
+    """Register a subscriber queue, primed with the latest status, starting the poller if needed."""
+    q = queue.Queue()
+    with _event_lock:
+        _event_subscribers.add(q)
+        if _event_state['poller'] is None:
+            _event_state['poller'] = Thread(target=events_poller, name='events', daemon=True)
+            _event_state['poller'].start()
+        elif _event_state['last'] is not None:
+            q.put(b'data: ' + _event_state['last'] + b'\n\n')
+    return q
 
-if __name__ == '__main__':
-    # Port can be configured via environment variable
-    # Default: 8000 for manual runs, systemd can set PORT=8080
-    port = int(os.getenv('PORT', 8000))
+def events_unsubscribe(q):
+    with _event_lock:
+        _event_subscribers.discard(q)
 
-    print("Starting Tibber Relay Web Backend...")
-    print("Access restricted to Tailscale network (100.x.x.x)")
-    print(f"Dashboard available at http://<tailscale-ip>:{port}/")
+@app.route('/api/events')
+def events():
+    """Stream relay status changes as Server-Sent Events."""
+    def stream():
+        q = events_subscribe()
+        try:
+            while True:
+                try:
+                    yield q.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield b': keep-alive\n\n'
+        finally:
+            events_unsubscribe(q)
 
-    # Run on all interfaces, protected by Tailscale middleware
-    app.run(host='0.0.0.0', port=port, debug=False)
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response